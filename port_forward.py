@@ -7,6 +7,10 @@
   '--yaml-to-stdout' outputs resulting configuration yaml to STDOUT,
     merged from STDIN yaml if '--yaml-from-stdin'
 
+  if XDG_RUNTIME_DIR is set, the resulting mapping is stored in
+    $XDG_RUNTIME_DIR/port_forward.<serve_port>.yaml and reused for half its lifetime,
+    as long as the local address used to reach the gateway stays the same
+
   can be used in combination with serve_once.py, eg.:
     r="$(printf 'serve_port: 48443\\nrequest_method: POST\\npayload: true\\nrequest_body_stdout: true\\n' \\
         | port_forward.py --yaml-from-stdin --yaml-to-stdout | serve_once.py --yes)"
@@ -14,15 +18,51 @@
 
 
 import argparse
-import copy
+import functools
 import os
 import socket
+import struct
 import sys
 import textwrap
+import time
+from collections.abc import Mapping
 
 import natpmp
 import yaml
 
+try:
+    from yaml import CSafeDumper as _Dumper
+    from yaml import CSafeLoader as _Loader
+except ImportError:
+    from yaml import SafeDumper as _Dumper
+    from yaml import SafeLoader as _Loader
+
+PCP_PORT = 5351
+PCP_VERSION = 2
+PCP_OPCODE_MAP = 1
+PCP_PROTOCOL_TCP = 6
+PCP_MAX_TIMEOUT = 4
+PCP_RESULT_SUCCESS = 0
+PCP_RESULT_UNSUPP_VERSION = 1
+PCP_RESULT_STR = {
+    1: "UNSUPP_VERSION",
+    2: "NOT_AUTHORIZED",
+    3: "MALFORMED_REQUEST",
+    4: "UNSUPP_OPCODE",
+    5: "UNSUPP_OPTION",
+    6: "MALFORMED_OPTION",
+    7: "NETWORK_FAILURE",
+    8: "NO_RESOURCES",
+    9: "UNSUPP_PROTOCOL",
+    10: "USER_EX_QUOTA",
+    11: "CANNOT_PROVIDE_EXTERNAL",
+    12: "ADDRESS_MISMATCH",
+    13: "EXCESSIVE_REMOTE_PEERS",
+}
+NATPMP_RESULT_UNSUPP_VERSION = 1
+_IPV4_MAPPED_PREFIX = b"\x00" * 10 + b"\xff\xff"
+_PUBLIC_ADDR_REQUEST = natpmp.PublicAddressRequest()
+
 
 def error_print(message, print_help=False):
     print("Error:  {}".format(message), file=sys.stderr)
@@ -31,78 +71,185 @@ def error_print(message, print_help=False):
     sys.exit(1)
 
 
-def merge_dict_struct(struct1, struct2):
-    "recursive merge of two dict like structs into one, struct2 takes precedence over struct1 if entry not None"
+def positive_int(value):
+    "argparse type for integers >= 1"
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be at least 1, got {}".format(value))
+    return number
 
-    def is_dict_like(v):
-        return hasattr(v, "keys") and hasattr(v, "values") and hasattr(v, "items")
 
-    def is_list_like(v):
-        return hasattr(v, "append") and hasattr(v, "extend") and hasattr(v, "pop")
+def merge_dict_struct(struct1, struct2):
+    "recursive merge of two dict like structs into one, struct2 takes precedence over struct1 if entry not None"
 
-    merged = copy.deepcopy(struct1)
-    if is_dict_like(struct1) and is_dict_like(struct2):
-        for key in struct2:
+    if isinstance(struct1, Mapping) and isinstance(struct2, Mapping):
+        # copy, dicts and lists of struct1 are never shared with the result
+        merged = {
+            key: merge_dict_struct(value, None) if isinstance(value, (Mapping, list)) else value
+            for key, value in struct1.items()
+        }
+        for key, value in struct2.items():
             if key in struct1:
                 # if the key is present in both dictionaries, recursively merge the values
-                merged[key] = merge_dict_struct(struct1[key], struct2[key])
+                merged[key] = merge_dict_struct(struct1[key], value)
             else:
-                merged[key] = struct2[key]
-    elif is_list_like(struct1) and is_list_like(struct2):
-        for item in struct2:
-            if item not in struct1:
-                merged.append(item)
-    elif is_dict_like(struct1) and struct2 is None:
-        # do nothing if first is dict, but second is None
-        pass
-    elif is_list_like(struct1) and struct2 is None:
-        # do nothing if first is list, but second is None
-        pass
-    else:
-        # the second input overwrites the first input
-        merged = struct2
-    return merged
-
-
+                merged[key] = value
+        return merged
+    if isinstance(struct1, list) and isinstance(struct2, list):
+        try:
+            seen = set(struct1)
+            return struct1 + [item for item in struct2 if item not in seen]
+        except TypeError:
+            # unhashable items, fall back to linear scan
+            return struct1 + [item for item in struct2 if item not in struct1]
+    if isinstance(struct1, Mapping) and struct2 is None:
+        # keep first if second is None, as copy so the result can be mutated safely
+        return merge_dict_struct(struct1, {})
+    if isinstance(struct1, list) and struct2 is None:
+        return list(struct1)
+    # the second input overwrites the first input
+    return struct2
+
+
+@functools.lru_cache(maxsize=1)
 def get_default_gateway_ip():
+    try:
+        # optional, ask the kernel via netlink instead of parsing /proc
+        from pyroute2 import IPRoute, NetlinkError
+    except ImportError:
+        IPRoute = None
+
+    if IPRoute is not None:
+        try:
+            with IPRoute() as ipr:
+                for route in ipr.get_default_routes(family=socket.AF_INET):
+                    gateway_ip = route.get_attr("RTA_GATEWAY")
+                    if gateway_ip:
+                        return gateway_ip
+        except (OSError, NetlinkError):
+            # netlink unavailable, eg. blocked by seccomp or container policy, use /proc
+            pass
+
     if os.path.exists("/proc/net/route"):
-        r_data = open("/proc/net/route", "r").read()
-        for r_line in r_data.splitlines():
-            r_fields = r_line.strip().split("\t")
-            if len(r_fields) >= 3 and r_fields[1] == "00000000":
-                ip_hex = r_fields[2]
-                if sys.byteorder == "little":
-                    ip_bytes = bytes.fromhex(ip_hex)[::-1]
-                else:
-                    ip_bytes = bytes.fromhex(ip_hex)
-                ip_address = socket.inet_ntoa(ip_bytes)
-                return ip_address
+        with open("/proc/net/route", "rb") as r_file:
+            # skip header, kernel guarantees a fixed column layout for the rest
+            r_file.readline()
+            for r_line in r_file:
+                r_fields = r_line.split(b"\t")
+                if r_fields[1] == b"00000000":
+                    # kernel prints the address as host byte order integer
+                    return socket.inet_ntoa(struct.pack("=I", int(r_fields[2], 16)))
     return None
 
 
+@functools.lru_cache(maxsize=1)
 def get_default_host_ip():
     try:
         gateway_addr = socket.gethostbyname(socket.gethostname())
-        if (
-            not socket.inet_pton(socket.AF_INET, gateway_addr)
-            or gateway_addr.startswith("127.")
-            or gateway_addr.startswith("::1")
-        ):
+        # gethostbyname always returns an IPv4 dotted-quad, only loopback needs filtering
+        if gateway_addr.startswith(("127.", "::1")):
             gateway_addr = None
     except socket.gaierror:
         gateway_addr = None
     return gateway_addr
 
 
-def get_public_ip(config):
-    gateway_ip, protocol, retry = (
-        config["port_forward"][c] for c in ["gateway_ip", "protocol", "retry"]
+def pcp_map(gateway_ip, serve_port, public_port, lifetime, retry):
+    """send a PCP (RFC 6887) MAP request for TCP serve_port
+
+    returns (result, public_ip, public_port, lifetime), lifetime as granted by the gateway.
+    result is None if the gateway did not answer, PCP_RESULT_UNSUPP_VERSION if the gateway
+    only speaks NAT-PMP. the response carries the external address, pass the returned tuple
+    to get_public_ip and port_forward to serve both with one exchange.
+    """
+    nonce = os.urandom(12)
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.connect((gateway_ip, PCP_PORT))
+        client_ip = _IPV4_MAPPED_PREFIX + socket.inet_aton(sock.getsockname()[0])
+        request = struct.pack(
+            "!BBHI16s12sB3xHH16s",
+            PCP_VERSION,
+            PCP_OPCODE_MAP,
+            0,
+            lifetime,
+            client_ip,
+            nonce,
+            PCP_PROTOCOL_TCP,
+            serve_port,
+            public_port,
+            _IPV4_MAPPED_PREFIX + bytes(4),
+        )
+        for n in range(1, retry + 1):
+            # natpmp backoff, 500ms initial timeout doubled on each try, but capped
+            sock.settimeout(min(0.250 * (2**n), PCP_MAX_TIMEOUT))
+            try:
+                sock.send(request)
+                data = sock.recv(1100)
+            except socket.timeout:
+                continue
+            except OSError as e:
+                print("PCP request failed: {}".format(e), file=sys.stderr)
+                return None, None, None, None
+            if len(data) < 4:
+                continue
+            version, result = data[0], data[3]
+            if version == 0:
+                # NAT-PMP only gateway, answers with version 0 and a 16 bit result code
+                natpmp_result = struct.unpack("!H", data[2:4])[0]
+                if natpmp_result == NATPMP_RESULT_UNSUPP_VERSION:
+                    return PCP_RESULT_UNSUPP_VERSION, None, None, None
+                print(
+                    "PCP request answered by NAT-PMP: {}".format(natpmp.error_str(natpmp_result)),
+                    file=sys.stderr,
+                )
+                return None, None, None, None
+            if result == PCP_RESULT_UNSUPP_VERSION:
+                # PCP server of another version, fall back to NAT-PMP
+                return result, None, None, None
+            if version != PCP_VERSION:
+                print("PCP response with unsupported version {}".format(version), file=sys.stderr)
+                return None, None, None, None
+            if result != PCP_RESULT_SUCCESS:
+                print("PCP error: {}".format(PCP_RESULT_STR.get(result, result)), file=sys.stderr)
+                return result, None, None, None
+            if len(data) < 60 or data[1] != 0x80 | PCP_OPCODE_MAP or data[24:36] != nonce:
+                continue
+            granted_lifetime = struct.unpack("!I", data[4:8])[0]
+            external_port = struct.unpack("!H", data[42:44])[0]
+            external_ip = data[44:60]
+            if external_ip.startswith(_IPV4_MAPPED_PREFIX):
+                external_ip = socket.inet_ntoa(external_ip[12:])
+            else:
+                external_ip = socket.inet_ntop(socket.AF_INET6, external_ip)
+            return result, external_ip, external_port, granted_lifetime
+    print("PCP request to {} timed out".format(gateway_ip), file=sys.stderr)
+    return None, None, None, None
+
+
+@functools.lru_cache(maxsize=None)
+def _port_map_request(serve_port, public_port, lifetime):
+    return natpmp.PortMapRequest(
+        protocol=natpmp.NATPMP_PROTOCOL_TCP,
+        private_port=serve_port,
+        public_port=public_port,
+        lifetime=lifetime,
     )
-    if protocol == "natpmp":
-        request = natpmp.PublicAddressRequest()
+
+
+def get_public_ip(config, pcp_mapping=None):
+    pf = config["port_forward"]
+    if pcp_mapping is not None and pcp_mapping[0] != PCP_RESULT_UNSUPP_VERSION:
+        # external address from the MAP response of pcp_map
+        return pcp_mapping[1]
+    if pf.get("public_ip"):
+        # already known, eg. from a previous invocation piped in via STDIN
+        return pf["public_ip"]
+    gateway_ip, protocol, retry = pf["gateway_ip"], pf["protocol"], pf["retry"]
+    if protocol in ("natpmp", "pcp"):
+        # PCP has no public address request, use the read-only NAT-PMP one
         response = natpmp.send_request_with_retry(
             gateway_ip=gateway_ip,
-            request=request,
+            request=_PUBLIC_ADDR_REQUEST,
             response_data_class=natpmp.PublicAddressResponse,
             retry=retry,
             response_size=12,
@@ -114,56 +261,160 @@ def get_public_ip(config):
             return None
 
 
-def port_forward(config):
+def port_forward(config, pcp_mapping=None):
+    "request mapping, return (public_port, lifetime) as granted by the gateway or None on failure"
     serve_port = config["serve_port"]
-    public_port, gateway_ip, protocol, lifetime, retry = (
-        config["port_forward"][c]
-        for c in ["public_port", "gateway_ip", "protocol", "lifetime", "retry"]
-    )
-
+    pf = config["port_forward"]
+    public_port, gateway_ip, protocol = pf["public_port"], pf["gateway_ip"], pf["protocol"]
+    lifetime, retry = pf["lifetime"], pf["retry"]
+
+    if protocol == "pcp":
+        if pcp_mapping is None:
+            pcp_mapping = pcp_map(gateway_ip, serve_port, public_port, lifetime, retry)
+        result, _, mapped_port, granted_lifetime = pcp_mapping
+        if result == PCP_RESULT_SUCCESS:
+            return mapped_port, granted_lifetime
+        if result != PCP_RESULT_UNSUPP_VERSION:
+            return None
+        # fall back to NAT-PMP
+        protocol = "natpmp"
     if protocol == "natpmp":
-        request = natpmp.PortMapRequest(
-            protocol=natpmp.NATPMP_PROTOCOL_TCP,
-            private_port=serve_port,
-            public_port=public_port,
-            lifetime=lifetime,
-        )
         response = natpmp.send_request_with_retry(
             gateway_ip=gateway_ip,
-            request=request,
+            request=_port_map_request(serve_port, public_port, lifetime),
             response_data_class=natpmp.PortMapResponse,
             retry=retry,
         )
         if response.result == 0:
-            return response.public_port
+            return response.public_port, response.lifetime
         else:
             print(natpmp.error_str(response.result), file=sys.stderr)
             return None
 
 
-default_config_str = """
-serve_port:
-port_forward:
-  protocol: "natpmp"
-  gateway_ip:
-  public_ip:
-  public_port:
-  lifetime: 3600
-  retry: 9
-"""
+def state_path(serve_port):
+    "path of the port mapping state file for serve_port, None if there is no user runtime dir"
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if not runtime_dir:
+        return None
+    return os.path.join(runtime_dir, "port_forward.{}.yaml".format(serve_port))
 
-default_config = yaml.safe_load(default_config_str)
-default_short = textwrap.fill(
-    ", ".join(["{}: {}".format(k, v) for k, v in default_config.items()]),
-    width=80,
-    initial_indent="  ",
-    subsequent_indent="  ",
-)
+
+def get_source_ip(gateway_ip):
+    "local address used to reach gateway_ip, None if there is no route"
+    try:
+        # connecting a UDP socket only selects the route, nothing is sent
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.connect((gateway_ip, PCP_PORT))
+            return sock.getsockname()[0]
+    except (OSError, TypeError):
+        return None
+
+
+def read_state(config):
+    "return (public_ip, public_port) of a still fresh mapping matching config, else None"
+    path = state_path(config["serve_port"])
+    pf = config["port_forward"]
+    if not path or pf["lifetime"] == 0 or not os.path.exists(path):
+        # lifetime 0 deletes the mapping, always send it
+        return None
+    try:
+        with open(path, "rb") as state_file:
+            state = yaml.load(state_file, Loader=_Loader)
+    except (OSError, yaml.YAMLError):
+        return None
+    # same gateway IP on another network (eg. 192.168.1.1) is a different router
+    source_ip = get_source_ip(pf["gateway_ip"])
+    if not source_ip:
+        return None
+    now = time.time()
+    try:
+        if (
+            state["serve_port"] != config["serve_port"]
+            or state["request_port"] != pf["public_port"]
+            or state["gateway_ip"] != pf["gateway_ip"]
+            or state["protocol"] != pf["protocol"]
+            or state["lifetime"] != pf["lifetime"]
+            or state["source_ip"] != source_ip
+            or now >= state["expiry"]
+            # clock jumped backwards or edited file, expiry can not be that far ahead
+            or state["expiry"] - now > state["granted_lifetime"] / 2
+        ):
+            return None
+        return state["public_ip"], state["public_port"]
+    except (KeyError, TypeError):
+        # truncated or edited state file, treat as cache miss
+        return None
+
+
+def write_state(config, public_ip, public_port, granted_lifetime):
+    """store mapping, considered fresh for half of the lifetime granted by the gateway,
+    to be safe against gateway reboots
+
+    a mapping requested with lifetime 0 was deleted, its state file is removed instead
+    """
+    path = state_path(config["serve_port"])
+    if not path:
+        return
+    pf = config["port_forward"]
+    if pf["lifetime"] == 0:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return
+    source_ip = get_source_ip(pf["gateway_ip"])
+    if not source_ip:
+        return
+    state = {
+        "serve_port": config["serve_port"],
+        "request_port": pf["public_port"],
+        "gateway_ip": pf["gateway_ip"],
+        "protocol": pf["protocol"],
+        "lifetime": pf["lifetime"],
+        "source_ip": source_ip,
+        "granted_lifetime": granted_lifetime,
+        "public_ip": public_ip,
+        "public_port": public_port,
+        "expiry": time.time() + granted_lifetime / 2,
+    }
+    try:
+        with open(path, "w") as state_file:
+            yaml.dump(state, state_file, Dumper=_Dumper, default_flow_style=False)
+    except OSError:
+        pass
+
+
+default_config = {
+    "serve_port": None,
+    "port_forward": {
+        "protocol": "natpmp",
+        "gateway_ip": None,
+        "public_ip": None,
+        "public_port": None,
+        "lifetime": 3600,
+        "retry": 4,
+    },
+}
+
+
+class DefaultsHelpParser(argparse.ArgumentParser):
+    "ArgumentParser that appends the defaults to the description only when help is rendered"
+
+    def format_help(self):
+        default_short = textwrap.fill(
+            ", ".join(["{}: {}".format(k, v) for k, v in default_config.items()]),
+            width=80,
+            initial_indent="  ",
+            subsequent_indent="  ",
+        )
+        self.description = __doc__ + "\ndefaults:\n{}\n".format(default_short)
+        return super().format_help()
 
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(
-        description=__doc__ + "\ndefaults:\n{}\n".format(default_short),
+    parser = DefaultsHelpParser(
+        description=__doc__,
         formatter_class=argparse.RawTextHelpFormatter,
     )
     parser.add_argument("--yaml-from-stdin", action="store_true", help="Read input from STDIN")
@@ -179,11 +430,18 @@ if __name__ == "__main__":
     parser.add_argument(
         "--protocol",
         type=str,
-        default="natpmp",
-        choices=["natpmp"],
-        help="port forwarding protocol",
+        default=argparse.SUPPRESS,
+        choices=["natpmp", "pcp"],
+        help="port forwarding protocol, pcp falls back to natpmp if unsupported by gateway",
     )
     parser.add_argument("--lifetime", type=int, help="lifetime in seconds")
+    parser.add_argument(
+        "--retry",
+        type=positive_int,
+        default=argparse.SUPPRESS,
+        help="number of request tries (>= 1), the default 4 waits at most 7.5s\n"
+        + "timeout starts at 500ms and doubles each try, pcp caps it at 4s",
+    )
     parser.add_argument(
         "--yaml-to-stdout",
         action="store_true",
@@ -226,29 +484,38 @@ if __name__ == "__main__":
     if args.get_host_ip:
         host_ip = get_default_host_ip()
         print(host_ip)
-        sys.exit(0) if host_ip else sys.exit(1)
+        sys.exit(0 if host_ip else 1)
 
     if args.get_gateway_ip:
         gateway_ip = get_default_gateway_ip()
         print(gateway_ip)
-        sys.exit(0) if gateway_ip else sys.exit(1)
+        sys.exit(0 if gateway_ip else 1)
 
     if args.yaml_from_stdin:
-        stdin_str = sys.stdin.read()
-        if not stdin_str.strip():
+        # bytes, libyaml does its own utf-8 decoding
+        stdin_data = sys.stdin.buffer.read()
+        if not stdin_data.strip():
             error_print("Error: Arg --yaml-from-stdin supplied, but no data from STDIN")
-        loaded_config = yaml.safe_load(stdin_str)
+        loaded_config = yaml.load(stdin_data, Loader=_Loader)
         if "serve_port" not in loaded_config:
             error_print("serve_port: <port> must be part of STDIN if --yaml-from-stdin")
-        if "port_forward" not in loaded_config:
-            loaded_config["port_forward"] = {}
+        # missing or empty 'port_forward:' key, both use the defaults
+        loaded_config["port_forward"] = loaded_config.get("port_forward") or {}
 
     if args.serve_port:
         loaded_config["serve_port"] = args.serve_port
 
-    for i in ["public_port", "gateway_ip", "lifetime", "retry"]:
-        if hasattr(args, i):
-            loaded_config["port_forward"][i] = getattr(args, i)
+    # only set options given on the commandline, keep STDIN or default values otherwise
+    pf = loaded_config["port_forward"]
+    for key, value in (
+        ("public_port", args.public_port),
+        ("gateway_ip", args.gateway_ip),
+        ("protocol", getattr(args, "protocol", None)),
+        ("lifetime", args.lifetime),
+        ("retry", getattr(args, "retry", None)),
+    ):
+        if value is not None:
+            pf[key] = value
 
     # merge YAML config with defaults
     config = merge_dict_struct(default_config, loaded_config)
@@ -259,23 +526,47 @@ if __name__ == "__main__":
     if not config["port_forward"]["gateway_ip"]:
         config["port_forward"]["gateway_ip"] = get_default_gateway_ip()
 
-    public_ip = get_public_ip(config)
-    if not public_ip:
-        sys.exit(1)
-
     if args.get_public_ip:
+        # read-only, never creates a mapping
+        public_ip = get_public_ip(config)
+        if not public_ip:
+            sys.exit(1)
         print(public_ip)
         sys.exit(0)
 
-    public_port = port_forward(config)
-    if not public_port:
-        sys.exit(1)
+    # reuse a still fresh mapping from a previous invocation
+    state = read_state(config)
+    if state:
+        public_ip, public_port = state
+    else:
+        pcp_mapping = None
+        if config["port_forward"]["protocol"] == "pcp":
+            # one MAP exchange carries external address and port, used for both below
+            pf = config["port_forward"]
+            pcp_mapping = pcp_map(
+                pf["gateway_ip"],
+                config["serve_port"],
+                pf["public_port"],
+                pf["lifetime"],
+                pf["retry"],
+            )
+
+        public_ip = get_public_ip(config, pcp_mapping)
+        if not public_ip:
+            sys.exit(1)
+
+        mapping = port_forward(config, pcp_mapping)
+        if mapping is None:
+            sys.exit(1)
+        # a deleted mapping (lifetime 0) is answered with public port 0
+        public_port, granted_lifetime = mapping
+        write_state(config, public_ip, public_port, granted_lifetime)
 
     config["port_forward"]["public_ip"] = public_ip
     config["port_forward"]["public_port"] = public_port
 
     # print updated config to STDOUT if --yaml-to-stdout
     if args.yaml_to_stdout:
-        print(yaml.safe_dump(config))
+        print(yaml.dump(config, Dumper=_Dumper, default_flow_style=False))
     elif not args.silent:
         print("{}:{}".format(public_ip, public_port))